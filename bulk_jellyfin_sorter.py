@@ -1,8 +1,29 @@
 #!/usr/bin/env python3
 
-from bulk_jellyfin_sorter import FileSorter
+from jellyfin_sorter import FileSorter
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import argparse
+import logging
+import logging.handlers
+import multiprocessing
+import os
+
+
+def _init_worker(log_queue):
+    # Workers forward their records to the parent, which owns the log file
+    logging.basicConfig(handlers=[logging.handlers.QueueHandler(log_queue)], level=logging.INFO)
+
+
+def _run_one(args):
+    path, dry_run = args
+    try:
+        fs = FileSorter(Path(path), dry_run=dry_run)
+        fs.sort_file()
+    except OSError as error:
+        # One bad folder must not stop the others
+        logging.error(error)
+
 
 if __name__ == '__main__':
         parser = argparse.ArgumentParser(description="Organize TV series")
@@ -11,12 +32,17 @@ if __name__ == '__main__':
         required.add_argument('-d', '--dryrun', help='target directory', action="store_true")
         args = parser.parse_args()
 
-        path = Path(args.path)
-        for p in path.iterdir():
-            try:
-                fs = FileSorter(p.resolve(), dry_run=args.dryrun)
-                fs.identify_attributes()
-                fs.rebuild_tree()
-            except FileExistsError:
-                print(f"{p.name} broke")
-                pass
\ No newline at end of file
+        path = Path(args.path).resolve()
+        with os.scandir(path) as it:
+            folders = [entry.path for entry in it if entry.is_dir(follow_symlinks=False)]
+
+        log_queue = multiprocessing.Queue()
+        listener = logging.handlers.QueueListener(log_queue,
+                                                  logging.StreamHandler(),
+                                                  logging.FileHandler(path.joinpath("jellyfin_sorter.log")))
+        listener.start()
+        try:
+            with ProcessPoolExecutor(initializer=_init_worker, initargs=(log_queue,)) as executor:
+                list(executor.map(_run_one, [(folder, args.dryrun) for folder in folders]))
+        finally:
+            listener.stop()
@@ -1,10 +1,79 @@
 #!/usr/bin/env python3
 
+import os
 import re
 import argparse
+import functools
 import logging
 from pathlib import Path
 
+try:
+    import re2 as _re
+except ImportError:
+    import re as _re
+
+VIDEO_EXTENSIONS = {r"mkv", r"mp4", r"avi", r"m4v"}
+MUSIC_EXTENSIONS = {r"flac", r"mp3", r"opus", r"wav", r"ogg"}
+FEATURETTE_DIRNAMES = {r"Behind The Scenes", r"Deleted Scenes",
+                       r"Featurettes", r"Interviews", r"Scenes", r"Shorts", r"Trailers", r"Other"}
+
+_TAG_PATTERNS: tuple[str, ...] = (
+    r"(?i:s)(?i:eason.?)?(?P<season>\d{1,})",
+    # r"(?i:e)(?i:pisode.?)?(?P<episode>\d{2,})",
+    r"(?:(?i:part.?)|((?i:e)(?i:pisode.?)?))(?P<episode>\d{2,})",
+    r"(?P<resolution>\d{3,4})p",
+    r"(?:\.|\()(?P<year>\d{4})(?:\.|\))",
+    r"\[(?P<tracker>\D+)\](\.\w+)?$",
+    fr"\.(?P<extension>(?i:{'|'.join(sorted(VIDEO_EXTENSIONS | MUSIC_EXTENSIONS))})$)",
+)
+# Each pattern is wrapped in a lookahead so that matches never consume characters another
+# pattern needs (e.g. the year's trailing dot is also the extension's leading dot). The
+# patterns start on disjoint characters, so at most one alternative can match per position.
+# RE2 has no lookarounds, so this one stays on the standard engine.
+_FUSED = re.compile("|".join(f"(?=(?:{p}))" for p in _TAG_PATTERNS))
+_SPACE_TO_DOT = str.maketrans({" ": "."})
+_STRIP = ".-_"
+_FEATURETTE_RX = _re.compile("(?i)" + "|".join(map(_re.escape, sorted(FEATURETTE_DIRNAMES))))
+
+
+def _scan_rec(path):
+    # Unreadable directories are skipped, like pathlib's glob does
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                yield entry
+                if entry.is_dir(follow_symlinks=False):
+                    yield from _scan_rec(entry.path)
+    except PermissionError:
+        return
+
+
+@functools.lru_cache(maxsize=8192)
+def _tags_for_name(name: str) -> tuple:
+    tags = {}
+    for match in _FUSED.finditer(name):
+        # Keep the leftmost hit of every group, as separate searches would
+        for key, value in match.groupdict().items():
+            if value is not None and key not in tags:
+                tags[key] = value
+    for int_tag in {"episode", "season", "year", "resolution"}:
+        if int_tag in tags:
+            tags[int_tag] = int(tags.get(int_tag))
+    return tuple(tags.items())
+
+
+def _get_tags_from_name(name: str) -> dict:
+    return dict(_tags_for_name(name))
+
+
+@functools.lru_cache(maxsize=8192)
+def _title_for_name(name: str) -> str:
+    # The title is everything before the earliest tag
+    first_tag = _FUSED.search(name)
+    title = name[:first_tag.start()] if first_tag else name
+    title = title.translate(_SPACE_TO_DOT).rstrip(_STRIP)
+    return ".".join(map(str.capitalize, title.split(".")))
+
 
 class Type:
     DEFAULT = 0
@@ -22,127 +91,93 @@ class Type:
 class FileInfo:
     def __init__(self, path):
         self.path = path
-        self.VIDEO_EXTENSIONS = {r"mkv", r"mp4", r"avi", r"m4v"}
-        self.MUSIC_EXTENSIONS = {r"flac", r"mp3", r"opus", r"wav", r"ogg"}
-
-        self.regex_searches = set()
-        self.regex_searches.add(r"(?i:s)(?i:eason.?)?(?P<season>\d{1,})")
-        # self.regex_searches.add(r"(?i:e)(?i:pisode.?)?(?P<episode>\d{2,})")
-        self.regex_searches.add(r"(?:(?i:part.?)|((?i:e)(?i:pisode.?)?))(?P<episode>\d{2,})")
-        self.regex_searches.add(r"(?P<resolution>\d{3,4})p")
-        self.regex_searches.add(r"(?:\.|\()(?P<year>\d{4})(?:\.|\))")
-        self.regex_searches.add(r"\[(?P<tracker>\D+)\](\.\w+)?$")
-        self.regex_searches.add(
-            fr"\.(?P<extension>(?i:{'|'.join(self.VIDEO_EXTENSIONS.union(self.MUSIC_EXTENSIONS))})$)")
-        self.regex_title = r"(?P<title>.*?)((" + ")|(".join(self.regex_searches) + "))"
         self.folder = self.path.is_dir()
         self.needs_subfolder = False
-        self.tags = self.get_tags(path)
+        self.tags = _get_tags_from_name(self.path.name)
         self.tags["title"] = self.get_title()
+        self._seasons = None
         self.type = self.get_type()
 
-    def file_children(self, path):
-        if path.is_dir():
-            return set(path.glob("*"))
-        else:
-            return {path}
-
-    def file_children_recursive(self, path):
-        if path.is_dir():
-            return set(path.rglob("*"))
+    def file_children(self):
+        if self.folder:
+            try:
+                with os.scandir(self.path) as it:
+                    return list(it)
+            except PermissionError:
+                return []
         else:
-            return {path}
+            return [self.path]
+
+    def _scan_once(self):
+        # Run lazily by the predicates that need the directory contents
+        if self._seasons is not None:
+            return
+        self._seasons = set()
+        self._episodes = set()
+        self._exts = set()
+        self._songs = 0
+        for entry in self.file_children():
+            tags = _get_tags_from_name(entry.name)
+            if tags.get("season"):
+                self._seasons.add(tags["season"])
+            if tags.get("episode") and entry.is_file():
+                self._episodes.add(tags["episode"])
+            if tags.get("extension"):
+                self._exts.add(tags["extension"])
+                if tags["extension"] in MUSIC_EXTENSIONS:
+                    self._songs += 1
+            if self.folder and entry.is_dir(follow_symlinks=False):
+                for child in _scan_rec(entry.path):
+                    if _get_tags_from_name(child.name).get("extension") in MUSIC_EXTENSIONS:
+                        self._songs += 1
 
     def get_title(self):
-        title_search_result = re.search(self.regex_title, self.path.name)
-        if title_search_result:
-            title = title_search_result.groupdict().get("title")
-        else:
-            title = self.path.name
-        title = title.replace(" ", ".").rstrip(".-_")
-        return ".".join([w.capitalize() for w in title.split(".")])
-
-    def get_tags(self, path):
-        tags = {}
-        for regex_search in self.regex_searches:
-            search_result = re.search(regex_search, path.name)
-            if search_result:
-                tags |= search_result.groupdict()
-        for int_tag in {"episode", "season", "year", "resolution"}:
-            if int_tag in tags:
-                tags[int_tag] = int(tags.get(int_tag))
-        return tags
-
-    def get_episodes(self, path) -> set:
-        episodes = set()
-        for p in self.file_children(path):
-            if p.is_file():
-                episode = self.get_tags(p).get("episode")
-                if episode:
-                    episodes.add(episode)
-        return episodes
+        return _title_for_name(self.path.name)
 
     def is_tv_episode(self) -> bool:
-        episodes = self.get_episodes(self.path)
-        if len(episodes) == 1:
-            self.tags["episode"] = episodes.pop()
+        self._scan_once()
+        if len(self._episodes) == 1:
+            self.tags["episode"] = next(iter(self._episodes))
             if not self.tags.get("season"):
                 self.tags["season"] = 1
             return True
         return False
 
-    def get_seasons(self, path) -> set:
-        seasons = set()
-        for p in self.file_children(path):
-            season = self.get_tags(p).get("season")
-            if season:
-                seasons.add(season)
-        return seasons
-
     def is_tv_season(self) -> bool:
+        self._scan_once()
         if self.folder:
-            seasons = self.get_seasons(self.path)
-            episodes = self.get_episodes(self.path)
-            if len(seasons) == 1:
-                self.tags["season"] = seasons.pop()
+            if len(self._seasons) == 1:
+                self.tags["season"] = next(iter(self._seasons))
                 return True
-            elif len(seasons) == 0 and len(episodes) > 1:
+            elif len(self._seasons) == 0 and len(self._episodes) > 1:
                 self.tags["season"] = 1
                 return True
         return False
 
     def is_tv_show(self) -> bool:
-        return len(self.get_seasons(self.path)) > 1
+        self._scan_once()
+        return len(self._seasons) > 1
 
     def is_featurette(self) -> bool:
-        featurette_dirnames = {r"Behind The Scenes", r"Deleted Scenes",
-                               r"Featurettes", r"Interviews", r"Scenes", r"Shorts", r"Trailers", r"Other"}
-        featurette_pattern = "|".join(featurette_dirnames)
-        return self.path.is_dir() and re.search(featurette_pattern, self.path.name, re.IGNORECASE)
+        return self.folder and _FEATURETTE_RX.search(self.path.name) is not None
 
     def is_movie(self) -> bool:
         return self.is_video()
 
     def is_video(self) -> bool:
-        for p in self.file_children(self.path):
-            if self.get_tags(p).get("extension") in self.VIDEO_EXTENSIONS:
-                return True
-        return False
-
-    def get_songs_count(self, path) -> int:
-        songs = 0
-        for p in self.file_children_recursive(self.path):
-            if self.get_tags(p).get("extension") in self.MUSIC_EXTENSIONS:
-                songs += 1
-        return songs
+        self._scan_once()
+        return not self._exts.isdisjoint(VIDEO_EXTENSIONS)
 
     def is_album(self) -> bool:
-        return self.get_songs_count(self.path) > 1
+        self._scan_once()
+        return self._songs > 1
 
     def is_song(self) -> bool:
-        return self.get_songs_count(self.path) == 1
+        self._scan_once()
+        return self._songs == 1
 
     def get_type(self):
+        # Featurettes are recognised by name alone, so they never trigger the directory scan
         if self.is_featurette():
             return Type.FEATURETTE
         if self.is_tv_episode():
@@ -187,9 +222,11 @@ class FileSorter:
         for media_path in media_paths:
             self.create_folder(media_path)
         self.global_tags = {}
+        self.hardlinks = []
 
     def sort_file(self):
         self.build_tree(self.path)
+        self.create_hardlinks()
 
     def create_folder(self, folder_path):
         try:
@@ -200,28 +237,42 @@ class FileSorter:
             pass
 
     def hardlink_to_folder(self, source, destination_folder, needs_subfolder=False):
-        if source != destination_folder:
-            if not self.dry_run:
+        self._queue_hardlinks(source, destination_folder, needs_subfolder)
+        self.create_hardlinks()
+
+    def _queue_hardlinks(self, source, destination_folder, needs_subfolder=False):
+        # Only queues the links, create_hardlinks() does the actual work
+        pending = [(source, destination_folder, needs_subfolder)]
+        while pending:
+            source, destination_folder, needs_subfolder = pending.pop()
+            if source == destination_folder:
+                logging.error(f"Cannot hardlink {source.name} with itself!")
+            elif not self.dry_run:
                 if source.is_file():
-                    self.create_folder(destination_folder)
+                    folder = os.fspath(destination_folder)
                     if needs_subfolder:
-                        destination_folder = destination_folder.joinpath(source.stem.replace(" ", "."))
-                        self.create_folder(destination_folder)
-                    destination_path = destination_folder.joinpath(source.name.replace(" ", "."))
-                    try:
-                        destination_path.hardlink_to(source)
-                        logging.info(f"Hardlinked {source.name} to {destination_path.resolve()}")
-                    except FileExistsError as error:
-                        logging.error(error)
+                        folder = os.path.join(folder, source.stem.replace(" ", "."))
+                    self.hardlinks.append((os.fspath(source), os.path.join(folder, source.name.replace(" ", "."))))
                 else:
                     for f in source.iterdir():
-                        self.hardlink_to_folder(f, destination_folder.joinpath(source.name))
-        else:
-            logging.error(f"Cannot hardlink {source.name} with itself!")
+                        pending.append((f, destination_folder.joinpath(source.name), False))
+
+    def create_hardlinks(self):
+        # Take the queue first so that a failing link cannot leave stale pairs behind
+        hardlinks, self.hardlinks = self.hardlinks, []
+        for folder in {os.path.dirname(destination) for _, destination in hardlinks}:
+            self.create_folder(Path(folder))
+        for source, destination in hardlinks:
+            try:
+                os.link(source, destination)
+                logging.info(f"Hardlinked {os.path.basename(source)} to {os.path.realpath(destination)}")
+            except FileExistsError as error:
+                logging.error(error)
 
     def hardlink_in_folder(self, source, destination_folder):
         for f in source.iterdir():
-            self.hardlink_to_folder(f, destination_folder)
+            self._queue_hardlinks(f, destination_folder)
+        self.create_hardlinks()
 
     def create_symlink(self, source, destination):
         try:
@@ -237,6 +288,11 @@ class FileSorter:
                 self.global_tags[key] = value
 
     def build_tree(self, path):
+        pending = [path]
+        while pending:
+            self.sort_path(pending.pop(), pending)
+
+    def sort_path(self, path, pending):
         file_info = FileInfo(path)
         logging.info(f"{file_info.path} is of type {file_info.type}")
         self.update_tags(file_info.tags)
@@ -249,23 +305,23 @@ class FileSorter:
                 featurette_path = self.shows_path.joinpath(file_info.tags.get("title"))
             else:  # Should never be reached
                 featurette_path = self.movies_path.joinpath(file_info.path.name)
-            self.hardlink_to_folder(file_info.path, featurette_path, file_info.needs_subfolder)
+            self._queue_hardlinks(file_info.path, featurette_path, file_info.needs_subfolder)
 
         elif file_info.type == Type.SHOW or file_info.type == Type.SHOW_SEASON:
-            for subfolder in file_info.path.glob("*"):
-                self.build_tree(subfolder)
+            # Reversed so that children are popped in listing order, depth first
+            pending.extend(reversed(list(file_info.path.glob("*"))))
 
         elif file_info.type == Type.SHOW_EPISODE:
             folder_path = self.shows_path.joinpath(
                 self.global_tags.get("title"),
                 f"season-{self.global_tags.get('season'):02}")
-            self.hardlink_to_folder(file_info.path, folder_path, file_info.needs_subfolder)
+            self._queue_hardlinks(file_info.path, folder_path, file_info.needs_subfolder)
 
         elif file_info.type == Type.MOVIE:
-            self.hardlink_to_folder(file_info.path, self.movies_path, file_info.needs_subfolder)
+            self._queue_hardlinks(file_info.path, self.movies_path, file_info.needs_subfolder)
 
         elif file_info.type in {Type.MUSIC_ALBUM, Type.MUSIC_SONG}:
-            self.hardlink_to_folder(file_info.path, self.music_path, file_info.needs_subfolder)
+            self._queue_hardlinks(file_info.path, self.music_path, file_info.needs_subfolder)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from jellyfin_sorter import FileInfo, FileSorter, Type
+
+
+class UnreadableDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.library = Path(self.tmp.name)
+        self.season = self.library.joinpath("Show S01")
+        self.locked = self.season.joinpath("locked")
+        self.locked.mkdir(parents=True)
+        for episode in ("Show.S01E01.mkv", "Show.S01E02.mkv"):
+            self.season.joinpath(episode).write_text(episode)
+
+        # chmod 000 does not stop root, so refuse the listing directly
+        scandir = os.scandir
+
+        def locked_scandir(path):
+            if path == os.fspath(self.locked) or path == self.locked:
+                raise PermissionError(13, "Permission denied", os.fspath(path))
+            return scandir(path)
+
+        patcher = mock.patch("os.scandir", side_effect=locked_scandir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unreadable_directory_is_default(self):
+        self.assertEqual(FileInfo(self.locked).type, Type.DEFAULT)
+
+    def test_unreadable_child_does_not_abort_sorting(self):
+        self.assertEqual(FileInfo(self.season).type, Type.SHOW_SEASON)
+        FileSorter(self.season, library_path=self.library).sort_file()
+        season_path = self.library.joinpath("Shows", "Show", "season-01")
+        self.assertTrue(season_path.joinpath("Show.S01E01", "Show.S01E01.mkv").is_file())
+        self.assertTrue(season_path.joinpath("Show.S01E02", "Show.S01E02.mkv").is_file())
+
+
+class FeaturetteTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.featurettes = Path(self.tmp.name).joinpath("Featurettes")
+        self.featurettes.mkdir()
+        self.featurettes.joinpath("Making.of.mkv").write_text("Making.of.mkv")
+
+    def test_predicates_scan_lazily(self):
+        file_info = FileInfo(self.featurettes)
+        self.assertEqual(file_info.type, Type.FEATURETTE)
+        self.assertTrue(file_info.is_video())
+        self.assertFalse(file_info.is_tv_show())
+        self.assertFalse(file_info.is_tv_season())
+        self.assertFalse(file_info.is_tv_episode())
+        self.assertFalse(file_info.is_album())
+        self.assertFalse(file_info.is_song())
+
+
+if __name__ == '__main__':
+    unittest.main()